@@ -1,3 +1,7 @@
+from .http_session_pool import HTTPSessionPool
+from .manifest_cache import ManifestCache
 from .data_store_agent import DataStoreAgent
-from .azul_agent import AzulAgent
+from .bundle_downloader import BundleDownloader, DownloadSummary
+from .async_data_store_agent import AsyncDataStoreAgent
+from .azul_agent import AzulAgent, BundleIndex
 from .analysis_agent import AnalysisAgent
@@ -1,12 +1,16 @@
 from cromwell_tools import api as cwm_api
 from cromwell_tools import cromwell_auth as cwm_auth
 from dcp_diag.component_entities.analysis_entities import Workflow
+from dcp_diag.component_agents.retry import RetryPolicy
 from contextlib import contextmanager
 import logging
 
 
 class AnalysisAgent:
-    def __init__(self, deployment, service_account_key):
+
+    DEFAULT_PAGE_SIZE = 200
+
+    def __init__(self, deployment, service_account_key, retry_policy=None):
         """Agent model for talking to the HCA DCP Secondary-analysis service.
 
         This model is designed to talk to the HCA DCP Secondary-analysis service, especially the underlying Cromwell
@@ -20,11 +24,14 @@ class AnalysisAgent:
                 no authentication required for talking to secondary analysis, which is very likely to break or skip
                 a lot of commands that are using this agent.
                 TODO: Add OAuth support to this agent so that users could authenticate through Google/Auth0.
+            retry_policy (RetryPolicy): Optional, how to retry requests that Cromwell throttles or fails transiently.
+                By default, it's RetryPolicy().
         """
         self.deployment = deployment
         self.cromwell_url = 'https://cromwell.caas-prod.broadinstitute.org'
         self.cromwell_collection = 'lira-test' if self.deployment == 'integration' else f'lira-{self.deployment}'
         self.auth = self._get_auth(service_account_key)
+        self.retry_policy = retry_policy or RetryPolicy()
 
     def _get_auth(self, service_account_key):
         """Helper function to generate the auth object to talk to Secondary-analysis service."""
@@ -92,7 +99,7 @@ class AnalysisAgent:
             'id': uuid,
             'additionalQueryResultFields': ['labels']
         }
-        response = cwm_api.query(query_dict=query_dict, auth=self.auth)
+        response = self.retry_policy.call(cwm_api.query, query_dict=query_dict, auth=self.auth)
         response.raise_for_status()
         result = response.json()
         all_workflows = result['results']
@@ -100,15 +107,44 @@ class AnalysisAgent:
         assert len(all_workflows) == total_count == 1
         return Workflow(all_workflows[0])
 
-    def query_by_bundle(self, bundle_uuid, bundle_version=None):
-        """Query the analysis workflows by their workflow-UUID.
+    def iter_query(self, query_dict, page_size=DEFAULT_PAGE_SIZE):
+        """Query the analysis workflows one page at a time, yielding Workflow objects as each page arrives.
+
+        Asking Cromwell for the labels of more than ~1000 workflows in one query will very likely fail, due to the open
+        issue: https://github.com/broadinstitute/cromwell/issues/3115, so this function pages through the results
+        using Cromwell's `page` and `pageSize` query keys instead.
 
-        Note, due to the open issue: https://github.com/broadinstitute/cromwell/issues/3115, if the result of workflows
-        are more than ~1000, this function will very likely raise an error.
+        Args:
+            query_dict (dict): A dictionary representing the query key-value pairs, as accepted by
+                `cromwell_tools.api.query`. It must not contain the `page` or `pageSize` keys.
+            page_size (int): Optional, the number of workflows to fetch per request. By default, it's 200.
+
+        Yields:
+            Workflow: Workflow objects, in the order Cromwell returns them.
+
+        Raises:
+            requests.exceptions.HTTPError: When a request to Secondary-analysis service (Cromwell) failed.
+        """
+        page = 1
+        while True:
+            paged_query_dict = dict(query_dict, page=str(page), pageSize=str(page_size))
+            response = self.retry_policy.call(cwm_api.query, query_dict=paged_query_dict, auth=self.auth)
+            response.raise_for_status()
+            result = response.json()
+            for workflow in result['results']:
+                yield Workflow(workflow)
+
+            if not result['results'] or page * page_size >= result['totalResultsCount']:
+                break
+            page += 1
+
+    def query_by_bundle(self, bundle_uuid, bundle_version=None, page_size=DEFAULT_PAGE_SIZE):
+        """Query the analysis workflows by their workflow-UUID.
 
         Args:
             bundle_uuid (str): HCA DCP bundle UUID.
             bundle_version (str): Optional, HCA DCP bundle version. By default, it's None.
+            page_size (int): Optional, the number of workflows to fetch per request. By default, it's 200.
 
         Returns:
             List[Workflow]: A list of Workflow objects. E.g. [Workflow_1, ..., Workflow_100]
@@ -126,25 +162,17 @@ class AnalysisAgent:
         if bundle_version:
             query_dict['label']['bundle-version'] = bundle_version
 
-        response = cwm_api.query(query_dict=query_dict, auth=self.auth)
-        response.raise_for_status()
-        result = response.json()
-        all_workflows = [Workflow(wf) for wf in result['results']]
-        return all_workflows
+        return list(self.iter_query(query_dict, page_size=page_size))
 
-    def query_by_project_uuid(self, project_uuid, with_labels=True):
+    def query_by_project_uuid(self, project_uuid, with_labels=True, page_size=DEFAULT_PAGE_SIZE):
         """Query the analysis workflows by the HCA DCP Ingest submission project-UUID, which is essentially one of the
             workflow labels.
 
-        Note, due to the open issue: https://github.com/broadinstitute/cromwell/issues/3115, if the result of workflows
-        are more than ~1000, this function will very likely raise an error. The `with_labels` is a flag controlling the
-        behavior of whether to query the workflows asking for the labels in the response, by default it's set to True,
-        so please set it to False if you don't want to risk getting error responses.
-
         Args:
             project_uuid (str): HCA DCP Ingest submission project-UUID.
             with_labels (bool): Optional, whether to query the workflows asking for the labels in the response,
                 by default it's True
+            page_size (int): Optional, the number of workflows to fetch per request. By default, it's 200.
 
         Returns:
             List[Workflow]: A list of Workflow objects. E.g. [Workflow_1, ..., Workflow_100]
@@ -152,6 +180,10 @@ class AnalysisAgent:
         Raises:
             requests.exceptions.HTTPError: When the request to Secondary-analysis service (Cromwell) failed.
         """
+        return list(self.iter_by_project_uuid(project_uuid, with_labels=with_labels, page_size=page_size))
+
+    def iter_by_project_uuid(self, project_uuid, with_labels=True, page_size=DEFAULT_PAGE_SIZE):
+        """Like query_by_project_uuid(), but yield the Workflow objects as each page of results arrives."""
         query_dict = {
             "label": {
                 "project_uuid": project_uuid
@@ -160,8 +192,4 @@ class AnalysisAgent:
         if with_labels:
             query_dict['additionalQueryResultFields'] = ['labels']
 
-        response = cwm_api.query(query_dict=query_dict, auth=self.auth)
-        response.raise_for_status()
-        result = response.json()
-        all_workflows = [Workflow(wf) for wf in result['results']]
-        return all_workflows
+        return self.iter_query(query_dict, page_size=page_size)
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+
+from .data_store_agent import DataStoreAgent
+from .retry import RETRYABLE_STATUS_CODES
+
+
+class AsyncDataStoreAgent(DataStoreAgent):
+
+    DEFAULT_MAX_IN_FLIGHT = 200
+
+    def __init__(self, deployment, max_in_flight=DEFAULT_MAX_IN_FLIGHT, manifest_cache=None):
+        """An asyncio flavour of DataStoreAgent, for issuing hundreds of concurrent DSS requests from one thread.
+
+        Use it as an async context manager, from inside a running event loop:
+
+            async with AsyncDataStoreAgent('prod') as dss:
+                manifest = await dss.bundle_manifest_async(bundle_uuid, replica='gcp')
+
+        Args:
+            deployment (str): The DSS deployment to talk to, e.g. "prod".
+            max_in_flight (int): Maximum number of requests outstanding at any one time.
+            manifest_cache (ManifestCache): Where to cache bundle manifests, defaults to the process-wide cache.
+        """
+        super().__init__(deployment, manifest_cache=manifest_cache)
+        self.max_in_flight = max_in_flight
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.BoundedSemaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        self._session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *args):
+        await self._session.close()
+        self._session = None
+
+    async def bundle_manifest_async(self, bundle_uuid, replica='aws', version=None):
+        if version:
+            manifest = self.manifest_cache.get(self._manifest_cache_key(bundle_uuid, version))
+            if manifest is not None:
+                return manifest
+        url, headers, cached_manifest = self._manifest_request(bundle_uuid, replica, version)
+        status, response_headers, manifest = await self._fetch_json('GET', url, headers=headers)
+        if status == 304:
+            return cached_manifest
+        assert response_headers['Content-type'] == 'application/json'
+        if status == 200:
+            self._cache_manifest(manifest, replica, etag=response_headers.get('ETag') if not version else None)
+        return manifest
+
+    async def bundle_version_async(self, bundle_uuid, replica='aws'):
+        url = f"{self.dss_url}/bundles/{bundle_uuid}"
+        params = {'replica': replica, 'per_page': self.BUNDLE_PRESENCE_CHECK_PAGE_SIZE}
+        try:
+            _, _, manifest = await self._fetch_json('GET', url, params=params)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 404:
+                return None
+            raise
+        return manifest['bundle']['version']
+
+    async def search_async(self, query, replica='aws', output_format='summary'):
+        results = []
+        url = f"{self.dss_url}/search"
+        query_params = {'replica': replica, 'output_format': output_format}
+        query_json = {'es_query': query}
+        page_size = self.RAW_SEARCH_PAGE_SIZE if output_format == 'raw' else 500
+        async for response in self.iter_pages_async(url, query_params=query_params, json_body=query_json,
+                                                    page_size=page_size):
+            if 'results' not in response:
+                raise RuntimeError(f"No results in response: {response}")
+            results.extend(response['results'])
+        return results
+
+    async def iter_pages_async(self, url, query_params={}, json_body={}, page_size=500):
+        params = query_params.copy()
+        params['per_page'] = page_size
+        full_url = url + '?' + urlencode(params)
+
+        while full_url:
+            _, headers, page = await self._fetch_json('POST', full_url, json=json_body)
+            full_url = self._next_page_url(headers)
+            yield page
+
+    async def _fetch_json(self, method, url, **kwargs):
+        """Make a request, retrying it with the same policy as the synchronous agents.
+
+        Returns:
+            tuple: (status, headers, parsed JSON body or None for a 304).
+
+        Raises:
+            aiohttp.ClientResponseError: If the final response was an error.
+        """
+        policy = self.http.retry_policy
+        metrics = self.http.metrics
+        for attempt in range(1, policy.max_attempts + 1):
+            last_attempt = attempt == policy.max_attempts
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    started_at = time.time()
+                    async with self._session.request(method, url, **kwargs) as response:
+                        retryable = response.status in RETRYABLE_STATUS_CODES
+                        metrics.record_request(method, str(response.url), response.status,
+                                               latency=time.time() - started_at,
+                                               bytes_received=response.content_length or 0,
+                                               retried=retryable and not last_attempt,
+                                               error=retryable and last_attempt)
+                        if not retryable or last_attempt:
+                            response.raise_for_status()
+                            body = None if response.status == 304 else await response.json(content_type=None)
+                            return response.status, response.headers, body
+                        retry_after = policy.retry_after(response.headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                metrics.record_request(method, url, latency=time.time() - started_at,
+                                       retried=not last_attempt, error=last_attempt)
+                if last_attempt:
+                    raise
+            await asyncio.sleep(policy.backoff(attempt, retry_after))
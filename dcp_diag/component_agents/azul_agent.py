@@ -1,15 +1,73 @@
-import requests
 import json
+import threading
+
+from .http_session_pool import HTTPSessionPool
+
+
+class BundleIndex:
+
+    def __init__(self, bundle_fqids):
+        """The bundles Azul has indexed for a project, keyed by both FQID and UUID for constant time lookups.
+
+        Args:
+            bundle_fqids (iterable): Bundle FQIDs of the form "<uuid>.<version>".
+        """
+        self.fqids = frozenset(bundle_fqids)
+        self.fqids_by_uuid = {}
+        for fqid in self.fqids:
+            self.fqids_by_uuid.setdefault(fqid.split('.', 1)[0], set()).add(fqid)
+
+    def __len__(self):
+        return len(self.fqids)
+
+    def __contains__(self, fqid):
+        return fqid in self.fqids
+
+    def has_uuid(self, bundle_uuid):
+        return bundle_uuid in self.fqids_by_uuid
+
+    def versions_of(self, bundle_uuid):
+        return self.fqids_by_uuid.get(bundle_uuid, set())
 
 
 class AzulAgent:
-    def __init__(self, deployment):
+    def __init__(self, deployment, session_pool=None, cache=None, fresh=False):
+        """
+        Args:
+            deployment (str): The Azul deployment to talk to, e.g. "prod".
+            session_pool (HTTPSessionPool): Connection pool to use, defaults to the process-wide one.
+            cache (DiskCache): If given, project bundle lists are kept here between runs.
+            fresh (bool): Ignore anything already in the cache, always asking Azul (the cache is still refreshed).
+        """
         self.deployment = deployment
+        self.http = session_pool or HTTPSessionPool.shared()
+        self.cache = cache
+        self.fresh = fresh
+        self._project_bundle_indexes = {}
+        # held while fetching, so phases that ask for the same project at the same time share one fetch
+        self._project_bundle_indexes_lock = threading.Lock()
         if self.deployment == 'prod':
             self.azul_service_url = 'https://service.explore.data.humancellatlas.org'
         else:
             self.azul_service_url = f'https://service.{deployment}.explore.data.humancellatlas.org'
 
+    def get_project_bundle_index(self, document_id):
+        """Return a BundleIndex of a project's bundles, fetching it from Azul (or the cache) only once."""
+        with self._project_bundle_indexes_lock:
+            if document_id not in self._project_bundle_indexes:
+                self._project_bundle_indexes[document_id] = BundleIndex(self._cached_project_bundle_fqids(document_id))
+            return self._project_bundle_indexes[document_id]
+
+    def _cached_project_bundle_fqids(self, document_id):
+        if self.cache is None:
+            return self.get_project_bundle_fqids(document_id)
+        cache_key = f"azul/{self.deployment}/projects/{document_id}/bundles"
+        bundle_fqids = None if self.fresh else self.cache.get(cache_key)
+        if bundle_fqids is None:
+            bundle_fqids = self.get_project_bundle_fqids(document_id)
+            self.cache.put(cache_key, sorted(bundle_fqids))
+        return bundle_fqids
+
     def get_project_bundle_fqids(self, document_id, page_size=1000):
         bundle_fqids = set()
 
@@ -29,7 +87,7 @@ class AzulAgent:
 
         while True:
             page += 1
-            response = requests.get(url, params=params)
+            response = self.http.get(url, params=params)
             response_json = response.json()
             hit_list = response_json.get('hits', [])
 
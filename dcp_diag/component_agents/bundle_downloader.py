@@ -0,0 +1,359 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from dcplib.checksumming_io import ChecksummingSink
+from dcplib.s3_multipart import get_s3_multipart_chunk_size
+
+from dcp_diag import DcpDiagException
+
+CHECKSUMS = ('crc32c', 'sha1', 'sha256', 's3_etag')
+VERIFY_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def verify_file(path, file_info):
+    """Check a file on disk against the size and checksums in its bundle manifest entry.
+
+    The file is read through a memory map, so this is cheap to run in a pool of processes.
+
+    Returns:
+        dict: {name: (expected, actual)} for the size and every checksum that doesn't match, empty if all is well.
+    """
+    size = os.path.getsize(path)
+    if size != file_info['size']:
+        return {'size': (file_info['size'], size)}
+    part_size = get_s3_multipart_chunk_size(size)
+    sink = ChecksummingSink(part_size, hash_functions=CHECKSUMS)
+    # S3Etag can only cope with a write crossing one part boundary
+    block_size = min(VERIFY_BLOCK_SIZE, part_size)
+    if size:
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for offset in range(0, size, block_size):
+                    sink.write(view[offset:offset + block_size])
+    return compare_checksums(file_info, sink.get_checksums())
+
+
+def compare_checksums(file_info, checksums):
+    """Returns {name: (expected, actual)} for every checksum that doesn't match the manifest entry file_info."""
+    return {name: (file_info[name], value)
+            for name, value in checksums.items()
+            if name in file_info and file_info[name].lower() != value.lower()}
+
+
+def describe_mismatches(mismatches):
+    return ", ".join(f"{name} is {actual} not {expected}" for name, (expected, actual) in sorted(mismatches.items()))
+
+
+class DownloadSummary:
+
+    def __init__(self, verify_only=False):
+        self.verify_only = verify_only
+        self.files_downloaded = 0
+        self.files_verified = 0
+        self.files_skipped = 0
+        self.failures = {}
+        self.bytes_downloaded = 0
+        self.started_at = time.time()
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def throughput(self):
+        """Bytes per second."""
+        return self.bytes_downloaded / self.elapsed if self.elapsed else 0
+
+    def __str__(self):
+        if self.verify_only:
+            return f"Verified {self.files_verified} files, {len(self.failures)} failed."
+        return (f"Downloaded {self.files_downloaded} files ({self.bytes_downloaded / 2**20:.1f} MiB) "
+                f"in {self.elapsed:.1f}s, {self.throughput / 2**20:.1f} MiB/s. "
+                f"{self.files_skipped} files were already present, {len(self.failures)} failed.")
+
+
+class FileDownload:
+
+    def __init__(self, file_info, save_as):
+        """A file being downloaded in one or more byte ranges, possibly resuming an earlier attempt.
+
+        Data is written to <save_as>.part, and the index and checksums of every range written are appended to
+        <save_as>.progress, so that an interrupted download only has to fetch the ranges it hadn't finished.  When
+        every range is done and the checksums match the manifest, the .part file is renamed to save_as.
+        """
+        self.file_info = file_info
+        self.save_as = save_as
+        self.part_path = save_as + '.part'
+        self.progress_path = save_as + '.progress'
+        self.size = file_info['size']
+        # Use the same part size as S3 multipart uploads, so ranges line up with the parts of the file's s3_etag
+        self.chunk_size = get_s3_multipart_chunk_size(self.size)
+        self.chunk_count = max(1, -(-self.size // self.chunk_size))
+        self.chunk_checksums = {}
+        self.url = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._url_lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.file_info['name']
+
+    def chunk_range(self, chunk_index):
+        start = chunk_index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size) - 1
+
+    def get_url(self, resolve):
+        """Resolve the URL to download from the first time it is needed, using resolve(file_info)."""
+        with self._url_lock:
+            if self.url is None:
+                self.url = resolve(self.file_info)
+            return self.url
+
+    def pending_chunks(self):
+        return [i for i in range(self.chunk_count) if i not in self.chunk_checksums]
+
+    def new_checksumming_sink(self):
+        """Return a sink for the checksums that can be computed from one range as it is written.
+
+        A file in one range gets every checksum in the manifest.  Ranges of a larger file arrive out of order, so
+        only the MD5 of each S3 multipart part, which together make up the s3_etag, can be computed as they are
+        written.
+        """
+        if self.chunk_count == 1:
+            return ChecksummingSink(self.chunk_size, hash_functions=CHECKSUMS)
+        return ChecksummingSink(self.chunk_size, hash_functions=('s3_etag',))
+
+    def checksums(self):
+        """Checksums of the whole file, assembled from those of its ranges."""
+        if self.chunk_count == 1:
+            return self.chunk_checksums[0]
+        part_digests = [bytes.fromhex(self.chunk_checksums[i]['s3_etag']) for i in range(self.chunk_count)]
+        return {'s3_etag': f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{self.chunk_count}"}
+
+    def prepare(self):
+        """Create the .part file, or pick up where a previous attempt at downloading this file version left off."""
+        if os.path.exists(self.part_path) and os.path.getsize(self.part_path) == self.size:
+            self.chunk_checksums = self._read_progress()
+        else:
+            self.chunk_checksums = {}
+            with open(self.part_path, 'wb') as fp:
+                fp.truncate(self.size)
+            self._write_progress_header()
+
+    def chunk_done(self, chunk_index, checksums):
+        """Record a range as written.  Returns True if that was the last one and the file is complete."""
+        with self._lock:
+            self.chunk_checksums[chunk_index] = checksums
+            with open(self.progress_path, 'a') as fp:
+                fp.write(json.dumps({'chunk': chunk_index, 'checksums': checksums}) + "\n")
+            return len(self.chunk_checksums) == self.chunk_count
+
+    def finish(self):
+        os.replace(self.part_path, self.save_as)
+        os.remove(self.progress_path)
+
+    def discard(self):
+        os.remove(self.part_path)
+        os.remove(self.progress_path)
+
+    def _progress_header(self):
+        return {'uuid': self.file_info['uuid'], 'version': self.file_info['version'], 'chunk_size': self.chunk_size}
+
+    def _write_progress_header(self):
+        with open(self.progress_path, 'w') as fp:
+            fp.write(json.dumps(self._progress_header()) + "\n")
+
+    def _read_progress(self):
+        try:
+            with open(self.progress_path) as fp:
+                lines = fp.readlines()
+            if not lines or json.loads(lines[0]) != self._progress_header():
+                raise ValueError("progress file is for a different download")
+        except (OSError, ValueError):
+            # We can't tell which ranges of the .part file are good, so start again
+            self._write_progress_header()
+            return {}
+        chunk_checksums = {}
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+                chunk_checksums[entry['chunk']] = entry['checksums']
+            except (ValueError, KeyError):  # a line cut short by an interrupted write
+                pass
+        return chunk_checksums
+
+
+class BundleDownloader:
+
+    DEFAULT_JOBS = 8
+    BUFFER_SIZE = 1024 * 1024
+    MAX_CHECKOUT_REDIRECTS = 30
+
+    def __init__(self, dss_agent, replica='aws', jobs=DEFAULT_JOBS):
+        """Download the files of DSS bundles concurrently.
+
+        Files are fetched in parallel, and large files are additionally split into byte ranges that are fetched in
+        parallel.  Checksums are computed from the data as it is written and checked against the manifest.  Files
+        already on disk with the right size and checksums are skipped, and partial downloads are resumed.
+
+        Args:
+            dss_agent (DataStoreAgent): Agent used to read bundle manifests and talk to the DSS.
+            replica (str): "aws" or "gcp".
+            jobs (int): Number of byte ranges to download at once.
+        """
+        self.dss = dss_agent
+        self.http = dss_agent.http
+        self.replica = replica
+        self.jobs = jobs
+        self._summary_lock = threading.Lock()
+
+    def download_bundle(self, bundle_uuid, target_folder, verify_only=False):
+        """Download a bundle into <target_folder>/<bundle_uuid>.
+
+        Args:
+            verify_only (bool): Don't download anything, just check the files already in the bundle folder against
+                the manifest, reading them in a pool of processes.
+
+        Returns:
+            DownloadSummary: What was downloaded, skipped and failed, and how fast.
+        """
+        summary = DownloadSummary(verify_only=verify_only)
+        manifest = self.dss.bundle_manifest(bundle_uuid, replica=self.replica)
+        bundle_folder = os.path.join(target_folder, bundle_uuid)
+        if verify_only:
+            self._verify_bundle_folder(bundle_folder, manifest['bundle']['files'], summary)
+            summary.finished_at = time.time()
+            return summary
+        os.makedirs(bundle_folder, exist_ok=True)
+
+        downloads = []
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            # Files already on disk with the right size are checksummed in the pool alongside the downloads of the
+            # others, rather than one after another before any download starts, and downloaded if they are bad.
+            verifications = {}
+            for file_info in manifest['bundle']['files']:
+                save_as = os.path.join(bundle_folder, file_info['name'])
+                if self._may_be_downloaded(save_as, file_info):
+                    verifications[executor.submit(verify_file, save_as, file_info)] = (file_info, save_as)
+                else:
+                    downloads.append(self._start_download(executor, file_info, save_as, summary))
+            for verification in as_completed(verifications):
+                file_info, save_as = verifications[verification]
+                try:
+                    already_downloaded = not verification.result()
+                except OSError:
+                    already_downloaded = False
+                if already_downloaded:
+                    print(f"Skipping {file_info['name']}, it is already downloaded")
+                    summary.files_skipped += 1
+                else:
+                    downloads.append(self._start_download(executor, file_info, save_as, summary))
+
+        for download in downloads:
+            if download.error:
+                summary.failures[download.name] = download.error
+                print(f"Failed to download {download.name}: {download.error}")
+        summary.finished_at = time.time()
+        return summary
+
+    def _start_download(self, executor, file_info, save_as, summary):
+        download = FileDownload(file_info, save_as)
+        download.prepare()
+        pending_chunks = download.pending_chunks()
+        if not pending_chunks:  # everything was written before we were interrupted last time
+            self._finish_file(download, summary)
+        for chunk_index in pending_chunks:
+            executor.submit(self._download_chunk, download, chunk_index, summary)
+        return download
+
+    def _download_chunk(self, download, chunk_index, summary):
+        if download.error:
+            return
+        try:
+            sink = download.new_checksumming_sink()
+            if download.size:
+                url = download.get_url(self._resolve_file_url)
+                start, end = download.chunk_range(chunk_index)
+                self._fetch_range(url, download.part_path, start, end, sink, summary)
+            if download.chunk_done(chunk_index, sink.get_checksums()):
+                self._finish_file(download, summary)
+        except Exception as e:
+            download.error = e
+
+    def _finish_file(self, download, summary):
+        mismatches = compare_checksums(download.file_info, download.checksums())
+        if mismatches:
+            download.discard()
+            download.error = DcpDiagException(f"checksum mismatch: {describe_mismatches(mismatches)}")
+            return
+        download.finish()
+        with self._summary_lock:
+            summary.files_downloaded += 1
+        print(f"Downloaded {download.name}")
+
+    def _verify_bundle_folder(self, bundle_folder, files, summary):
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            paths = [os.path.join(bundle_folder, file_info['name']) for file_info in files]
+            futures = [executor.submit(verify_file, path, file_info) for path, file_info in zip(paths, files)]
+            for file_info, future in zip(files, futures):
+                try:
+                    mismatches = future.result()
+                except OSError as e:
+                    summary.failures[file_info['name']] = e
+                    print(f"Cannot verify {file_info['name']}: {e}")
+                    continue
+                if mismatches:
+                    summary.failures[file_info['name']] = DcpDiagException(describe_mismatches(mismatches))
+                    print(f"{file_info['name']} is bad: {describe_mismatches(mismatches)}")
+                else:
+                    summary.files_verified += 1
+
+    def _fetch_range(self, url, path, start, end, sink, summary):
+        headers = {'Range': f"bytes={start}-{end}"}
+        offset = start
+        with self.http.get(url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if response.status_code != 206 and start != 0:
+                raise DcpDiagException(f"Server ignored request for byte range {start}-{end}")
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                for data in response.iter_content(chunk_size=self.BUFFER_SIZE):
+                    data = data[:end + 1 - offset]
+                    os.pwrite(fd, data, offset)
+                    sink.write(data)
+                    offset += len(data)
+                    if offset > end:
+                        break
+            finally:
+                os.close(fd)
+        if offset <= end:
+            raise DcpDiagException(f"Download of byte range {start}-{end} stopped at {offset}")
+        with self._summary_lock:
+            summary.bytes_downloaded += end + 1 - start
+
+    def _resolve_file_url(self, file_info):
+        """Find the pre-signed URL the DSS redirects file GETs to, so byte ranges can be requested from it directly."""
+        url = f"{self.dss.dss_url}/files/{file_info['uuid']}?replica={self.replica}&version={file_info['version']}"
+        for _ in range(self.MAX_CHECKOUT_REDIRECTS):
+            with self.http.get(url, allow_redirects=False, stream=True) as response:
+                if response.status_code == 301:  # the DSS is still checking the file out, try again later
+                    time.sleep(int(response.headers.get('Retry-After', 1)))
+                    url = response.headers['Location']
+                elif response.status_code == 302:
+                    return response.headers['Location']
+                else:
+                    response.raise_for_status()
+                    return url
+        raise DcpDiagException(f"Gave up waiting for DSS to check out file {file_info['uuid']}")
+
+    @staticmethod
+    def _may_be_downloaded(path, file_info):
+        """Whether a file is on disk with the right size, so is worth checksumming before downloading it again."""
+        return os.path.isfile(path) and os.path.getsize(path) == file_info['size']
@@ -2,28 +2,49 @@ import json
 import os
 from urllib.parse import urlencode
 
-import requests
+from .bundle_downloader import BundleDownloader
+from .http_session_pool import HTTPSessionPool
+from .manifest_cache import ManifestCache
 
 
 class DataStoreAgent:
 
-    def __init__(self, deployment):
+    def __init__(self, deployment, session_pool=None, manifest_cache=None):
         self.deployment = deployment
+        self.http = session_pool or HTTPSessionPool.shared()
+        self.manifest_cache = manifest_cache or ManifestCache.shared()
         if self.deployment == 'prod':
             self.dss_url = "https://dss.data.humancellatlas.org/v1"
         else:
             self.dss_url = "https://dss.{deployment}.data.humancellatlas.org/v1".format(deployment=deployment)
 
-    def search(self, query, replica='aws'):
-        results = []
+    # DSS refuses to return more than 10 results per page when asked for raw (full metadata) output
+    RAW_SEARCH_PAGE_SIZE = 10
+
+    def search(self, query, replica='aws', output_format='summary'):
+        return list(self.iter_search(query, replica=replica, output_format=output_format))
+
+    def iter_search(self, query, replica='aws', output_format='summary', progress_callback=None):
+        """Yield search results one at a time, only fetching the next page from the DSS when it is needed.
+
+        Args:
+            progress_callback (callable): If given, called after each page is fetched as
+                progress_callback(pages_fetched, results_fetched, total_hits).
+        """
         url = f"{self.dss_url}/search"
-        query_params = { 'replica': replica}
+        query_params = {'replica': replica, 'output_format': output_format}
         query_json = {'es_query': query}
-        for response in self.iter_pages(url, query_params=query_params, json_body=query_json):
+        page_size = self.RAW_SEARCH_PAGE_SIZE if output_format == 'raw' else 500
+        pages_fetched = 0
+        results_fetched = 0
+        for response in self.iter_pages(url, query_params=query_params, json_body=query_json, page_size=page_size):
             if 'results' not in response:
                 raise RuntimeError(f"No results in response: {response}")
-            results.extend(response['results'])
-        return results
+            pages_fetched += 1
+            results_fetched += len(response['results'])
+            if progress_callback:
+                progress_callback(pages_fetched, results_fetched, response.get('total_hits'))
+            yield from response['results']
 
     def iter_pages(self, url, query_params={}, json_body={}, page_size=500):
         params = query_params.copy()
@@ -31,42 +52,100 @@ class DataStoreAgent:
         full_url = url + '?' + urlencode(params)
 
         while True:
-            response = requests.post(full_url, json=json_body)
+            response = self.http.post(full_url, json=json_body)
             yield response.json()
 
-            link_header = response.headers.get('link', None)
-            if link_header:
-                next_link = link_header.split(';')[0]
-                full_url = next_link.strip('<').strip('>')
-            else:
+            full_url = self._next_page_url(response.headers)
+            if not full_url:
                 break
 
-    def download_bundle(self, bundle_uuid, target_folder):
-        print(f"Downloading bundle {bundle_uuid}:")
-        manifest = self.bundle_manifest(bundle_uuid)
-        bundle_folder = os.path.join(target_folder, bundle_uuid)
-        try:
-            os.makedirs(bundle_folder)
-        except FileExistsError:
-            pass
+    @staticmethod
+    def _next_page_url(headers):
+        link_header = headers.get('link', None)
+        if link_header:
+            next_link = link_header.split(';')[0]
+            return next_link.strip('<').strip('>')
+        return None
 
-        for f in manifest['bundle']['files']:
-            self.download_file(f['uuid'], save_as=os.path.join(bundle_folder, f['name']))
-        return bundle_folder
+    def download_bundle(self, bundle_uuid, target_folder, replica='aws', jobs=BundleDownloader.DEFAULT_JOBS,
+                        verify_only=False):
+        print(f"{'Verifying' if verify_only else 'Downloading'} bundle {bundle_uuid}:")
+        downloader = BundleDownloader(self, replica=replica, jobs=jobs)
+        summary = downloader.download_bundle(bundle_uuid, target_folder, verify_only=verify_only)
+        print(summary)
+        return os.path.join(target_folder, bundle_uuid)
 
-    def bundle_manifest(self, bundle_uuid, replica='aws'):
-        url = f"{self.dss_url}/bundles/{bundle_uuid}?replica={replica}"
-        response = requests.get(url)
-        assert response.ok
+    def bundle_manifest(self, bundle_uuid, replica='aws', version=None):
+        """Return a bundle manifest, from the manifest cache if possible.
+
+        A given version of a manifest is only ever fetched once.  Asking for the latest version always asks the DSS,
+        but if we already have the latest version we know of the request is conditional on its ETag, and the DSS
+        only sends the manifest again if it has changed.
+        """
+        if version:
+            manifest = self.manifest_cache.get(self._manifest_cache_key(bundle_uuid, version))
+            if manifest is not None:
+                return manifest
+        url, headers, cached_manifest = self._manifest_request(bundle_uuid, replica, version)
+        response = self.http.get(url, headers=headers)
+        if response.status_code == 304:
+            return cached_manifest
+        response.raise_for_status()
         assert response.headers['Content-type'] == 'application/json'
-        return json.loads(response.content)
+        manifest = json.loads(response.content)
+        if response.status_code == 200:  # not one page of a very large bundle
+            self._cache_manifest(manifest, replica, etag=response.headers.get('ETag') if not version else None)
+        return manifest
+
+    # The DSS has no HEAD for bundles, so check for them by asking for the smallest page of the manifest it will send
+    BUNDLE_PRESENCE_CHECK_PAGE_SIZE = 10
+
+    def bundle_version(self, bundle_uuid, replica='aws'):
+        """Check whether a bundle exists in a replica without downloading its (possibly huge) manifest.
+
+        Returns:
+            str: The latest version of the bundle, or None if the DSS doesn't have it.
+        """
+        url = f"{self.dss_url}/bundles/{bundle_uuid}"
+        params = {'replica': replica, 'per_page': self.BUNDLE_PRESENCE_CHECK_PAGE_SIZE}
+        response = self.http.get(url, params=params)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()['bundle']['version']
+
+    def _manifest_request(self, bundle_uuid, replica, version):
+        """Returns the URL and headers to fetch a manifest with, and the cached manifest a 304 response refers to."""
+        url = f"{self.dss_url}/bundles/{bundle_uuid}?replica={replica}"
+        if version:
+            return f"{url}&version={version}", {}, None
+        latest = self.manifest_cache.get(self._latest_version_cache_key(bundle_uuid, replica))
+        if latest:
+            cached_manifest = self.manifest_cache.get(self._manifest_cache_key(bundle_uuid, latest['version']))
+            if cached_manifest is not None:
+                return url, {'If-None-Match': latest['etag']}, cached_manifest
+        return url, {}, None
+
+    def _cache_manifest(self, manifest, replica, etag=None):
+        bundle_uuid = manifest['bundle']['uuid']
+        version = manifest['bundle']['version']
+        self.manifest_cache.put(self._manifest_cache_key(bundle_uuid, version), manifest)
+        if etag:
+            self.manifest_cache.put(self._latest_version_cache_key(bundle_uuid, replica),
+                                    {'version': version, 'etag': etag})
+
+    def _manifest_cache_key(self, bundle_uuid, version):
+        return f"dss/{self.deployment}/bundles/{bundle_uuid}.{version}"
+
+    def _latest_version_cache_key(self, bundle_uuid, replica):
+        return f"dss/{self.deployment}/{replica}/latest_bundles/{bundle_uuid}"
 
     def download_file(self, file_uuid, save_as, replica='aws'):
         url = f"{self.dss_url}/files/{file_uuid}?replica={replica}"
         print(f"Downloading file {file_uuid} to {save_as}")
-        response = requests.get(url, stream=True)
-        assert response.ok
-        with open(save_as, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
+        with self.http.get(url, stream=True) as response:
+            assert response.ok
+            with open(save_as, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=BundleDownloader.BUFFER_SIZE):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
@@ -0,0 +1,160 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from dcp_diag.metrics import Metrics
+from .retry import RETRYABLE_STATUS_CODES, AdaptiveConcurrencyLimiter, RetryPolicy
+
+
+class HTTPSessionPool:
+
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_MAX_HOSTS = 16
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_hosts=DEFAULT_MAX_HOSTS, retry_policy=None, metrics=None):
+        """A thread-safe pool of keep-alive HTTP connections shared by the component agents.
+
+        Every thread gets its own requests.Session (so cookies and other session state are never shared between
+        threads), but all of those sessions are mounted on a single HTTPAdapter, so the underlying TCP/TLS connections
+        are pooled and reused across threads and agents.
+
+        Requests that are throttled or hit a transient failure are retried with backoff, and the number of requests
+        in flight to each host is adjusted to what the host is coping with (see AdaptiveConcurrencyLimiter).
+
+        Args:
+            pool_size (int): Maximum number of connections kept open to any one host. Requests beyond this block
+                until a connection is returned to the pool, rather than opening throw-away connections.
+            max_hosts (int): Maximum number of hosts to keep connection pools for.
+            retry_policy (RetryPolicy): How to retry failed requests, defaults to RetryPolicy().
+            metrics (Metrics): Where to record every request attempt, defaults to the process-wide Metrics.
+        """
+        self.pool_size = pool_size
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics or Metrics.shared()
+        self._adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size, pool_block=True)
+        self._local = threading.local()
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide pool, creating it with default settings if need be."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, pool_size=DEFAULT_POOL_SIZE, max_hosts=DEFAULT_MAX_HOSTS):
+        """Replace the process-wide pool with one of the given size, e.g. to match a --jobs option."""
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.close()
+            cls._shared = cls(pool_size=pool_size, max_hosts=max_hosts)
+            return cls._shared
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            self._local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        limiter = self.limiter(urlparse(url).netloc)
+        policy = self.retry_policy
+        for attempt in range(1, policy.max_attempts + 1):
+            limiter.acquire()
+            started_at = time.time()
+            last_attempt = attempt == policy.max_attempts
+            # Unless the attempt gets as far as a response, count it as a failure, and always give the slot back:
+            # one that is never released is lost to every later request to the host.
+            overloaded = True
+            try:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                    # reads the body, unless streaming, which can fail too, e.g. if it is cut short
+                    bytes_received = self._bytes_received(response, kwargs.get('stream'))
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    self.metrics.record_request(method, url, latency=time.time() - started_at,
+                                                retried=not last_attempt, error=last_attempt)
+                    if last_attempt:
+                        raise
+                    retry_after = None
+                except BaseException:
+                    self.metrics.record_request(method, url, latency=time.time() - started_at, error=True)
+                    raise
+                else:
+                    overloaded = response.status_code in RETRYABLE_STATUS_CODES
+                    self.metrics.record_request(method, url, response.status_code, time.time() - started_at,
+                                                bytes_received=bytes_received,
+                                                retried=overloaded and not last_attempt,
+                                                error=overloaded and last_attempt)
+                    if not overloaded or last_attempt:
+                        return response
+                    response.close()
+                    retry_after = policy.retry_after(response.headers)
+            finally:
+                limiter.release(time.time() - started_at, overloaded=overloaded)
+            time.sleep(policy.backoff(attempt, retry_after))
+
+    @staticmethod
+    def _bytes_received(response, stream):
+        if stream:  # don't read the body on the caller's behalf, trust the server
+            return int(response.headers.get('Content-Length', 0))
+        return len(response.content)
+
+    def limiter(self, host):
+        """Return the concurrency limiter for a host, which starts at half the pool size and can grow to all of it."""
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = AdaptiveConcurrencyLimiter(initial_limit=max(1, self.pool_size // 2),
+                                                                  max_limit=self.pool_size)
+            return self._limiters[host]
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def connection_stats(self):
+        """Report how many connections were opened to, and reused for, each host.
+
+        Returns:
+            dict: e.g. {'dss.data.humancellatlas.org': {'opened': 10, 'reused': 1990}}
+        """
+        stats = {}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:  # evicted since we listed the keys
+                continue
+            host_stats = stats.setdefault(pool.host, {'opened': 0, 'reused': 0})
+            host_stats['opened'] += pool.num_connections
+            host_stats['reused'] += max(pool.num_requests - pool.num_connections, 0)
+        return stats
+
+    def total_connection_stats(self):
+        totals = {'opened': 0, 'reused': 0}
+        for host_stats in self.connection_stats().values():
+            totals['opened'] += host_stats['opened']
+            totals['reused'] += host_stats['reused']
+        return totals
+
+    def close(self):
+        self._adapter.close()
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+
+class ManifestCache:
+
+    DEFAULT_MAX_ENTRIES = 1000
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, disk_cache=None, max_entries=DEFAULT_MAX_ENTRIES):
+        """A cache of DSS bundle manifests: an in-memory LRU, optionally backed by a DiskCache.
+
+        A bundle version never changes, so manifests are cached by "<uuid>.<version>" and never expire.
+
+        Args:
+            disk_cache (DiskCache): Also keep manifests here, so they survive between runs.
+            max_entries (int): Number of manifests to hold in memory.
+        """
+        self.disk_cache = disk_cache
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide cache, creating an in-memory only one if need be."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def configure(cls, disk_cache=None, max_entries=DEFAULT_MAX_ENTRIES):
+        """Replace the process-wide cache, e.g. with one backed by a DiskCache."""
+        with cls._shared_lock:
+            cls._shared = cls(disk_cache=disk_cache, max_entries=max_entries)
+            return cls._shared
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.disk_cache is None:
+            return None
+        value = self.disk_cache.get(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, value)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
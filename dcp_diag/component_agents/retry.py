@@ -0,0 +1,141 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from dcp_diag.metrics import Metrics
+
+# Responses that mean "try again later": throttling, and gateways or services that are overloaded or restarting
+RETRYABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+class RetryPolicy:
+
+    DEFAULT_MAX_ATTEMPTS = 6
+    DEFAULT_BASE_DELAY = 0.5
+    DEFAULT_MAX_DELAY = 60
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        """How often, and how patiently, to retry requests that failed in a way that may go away on its own.
+
+        Args:
+            max_attempts (int): Give up after this many attempts (including the first).
+            base_delay (float): Seconds to wait, at most, before the first retry.  This doubles with every retry.
+            max_delay (float): Never wait longer than this many seconds between attempts.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait after the given (1-based) attempt failed.
+
+        Honours a server's Retry-After if there was one, otherwise uses exponential backoff with "full jitter", so
+        that clients which failed together don't all retry together.
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    @staticmethod
+    def retry_after(headers):
+        """Parse a Retry-After header, which is either a number of seconds or an HTTP date, into seconds."""
+        value = headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def call(self, request_function, *args, **kwargs):
+        """Call a function that makes an HTTP request and returns a requests.Response, retrying it as needed.
+
+        Returns:
+            requests.Response: The first response that wasn't worth retrying, or the last one if we gave up.
+
+        Raises:
+            requests.exceptions.ConnectionError, requests.exceptions.Timeout: If the last attempt raised them.
+        """
+        metrics = Metrics.shared()
+        for attempt in range(1, self.max_attempts + 1):
+            last_attempt = attempt == self.max_attempts
+            started_at = time.time()
+            try:
+                response = request_function(*args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                request = e.request
+                metrics.record_request(request.method if request else 'CALL',
+                                       request.url if request else request_function.__name__,
+                                       latency=time.time() - started_at, retried=not last_attempt, error=last_attempt)
+                if last_attempt:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            retryable = response.status_code in RETRYABLE_STATUS_CODES
+            metrics.record_request(response.request.method, response.request.url, response.status_code,
+                                   latency=time.time() - started_at, bytes_received=len(response.content),
+                                   retried=retryable and not last_attempt, error=retryable and last_attempt)
+            if not retryable or last_attempt:
+                return response
+            response.close()
+            time.sleep(self.backoff(attempt, self.retry_after(response.headers)))
+
+
+class AdaptiveConcurrencyLimiter:
+
+    # Latency this many times the running average is taken as a sign the host is starting to struggle
+    LATENCY_TOLERANCE = 2.0
+    # Don't halve the limit more than once per this many seconds, a burst of failures is one congestion event
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, initial_limit, max_limit, min_limit=1):
+        """Limits the number of requests in flight to one host, adjusting the limit AIMD style.
+
+        The limit grows by one for every "limit" requests that succeed promptly (additive increase), stays put while
+        latency is well above average, and halves when the host throttles us or fails (multiplicative decrease).
+
+        Args:
+            initial_limit (int): Requests allowed in flight to start with.
+            max_limit (int): Never allow more than this many.
+            min_limit (int): Never allow fewer than this many.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._average_latency = None
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, latency, overloaded=False):
+        """Give back a slot, reporting how long the request took and whether the host was overloaded."""
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded:
+                now = time.time()
+                if now - self._last_decrease >= self.DECREASE_INTERVAL:
+                    self._limit = max(self.min_limit, self._limit / 2)
+                    self._last_decrease = now
+            else:
+                if self._average_latency is None or latency <= self.LATENCY_TOLERANCE * self._average_latency:
+                    self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+                self._average_latency = latency if self._average_latency is None \
+                    else 0.9 * self._average_latency + 0.1 * latency
+            self._condition.notify_all()
@@ -1,8 +1,11 @@
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
 
 import boto3
 from botocore.errorfactory import ClientError
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, JSON
+from sqlalchemy import create_engine, func, Column, Integer, String, DateTime, ForeignKey, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker, Session
 from termcolor import colored
@@ -22,11 +25,69 @@ class UploadDbConfig(Config):
 
 class DBSessionMaker:
 
+    DEFAULT_POOL_SIZE = 5
+    DEFAULT_MAX_OVERFLOW = 5
+    # Replace connections older than this many seconds, before the database or a proxy drops them as idle
+    DEFAULT_POOL_RECYCLE = 1800
+
+    _pool_options = {
+        'pool_size': DEFAULT_POOL_SIZE,
+        'max_overflow': DEFAULT_MAX_OVERFLOW,
+        'pool_recycle': DEFAULT_POOL_RECYCLE
+    }
+    _database_uris = {}
+    _engines = {}
+    _session_makers = {}
+    _registry_lock = threading.Lock()
+
     def __init__(self, deployment):
-        engine = create_engine(UploadDbConfig(deployment=deployment).database_uri)
-        DbBase.metadata.bind = engine
-        self.session_maker = sessionmaker()
-        self.session_maker.bind = engine
+        """Hands out sessions on the Upload database of a deployment.
+
+        There is one engine (with its connection pool), and one sessionmaker, per deployment for the life of the
+        process, however many DBSessionMakers are created, so the database URI is only fetched from the secrets
+        manager, and connections only opened, once.
+        """
+        self.deployment = deployment
+        self.session_maker = self._session_maker(deployment)
+
+    @classmethod
+    def configure(cls, pool_size=DEFAULT_POOL_SIZE, max_overflow=DEFAULT_MAX_OVERFLOW,
+                  pool_recycle=DEFAULT_POOL_RECYCLE):
+        """Set the connection pool options of engines created from now on.
+
+        Args:
+            pool_size (int): Number of connections to keep open to each database.
+            max_overflow (int): Number of extra connections to open when they are all in use.
+            pool_recycle (int): Replace connections that have been open for longer than this many seconds.
+        """
+        with cls._registry_lock:
+            cls._pool_options = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_recycle': pool_recycle}
+
+    @classmethod
+    def engine(cls, deployment):
+        with cls._registry_lock:
+            if deployment not in cls._engines:
+                # pre-ping, so a connection the database has dropped is replaced rather than failing a query
+                cls._engines[deployment] = create_engine(cls._database_uri(deployment), pool_pre_ping=True,
+                                                         **cls._pool_options)
+            return cls._engines[deployment]
+
+    @classmethod
+    def _session_maker(cls, deployment):
+        engine = cls.engine(deployment)
+        with cls._registry_lock:
+            if deployment not in cls._session_makers:
+                cls._session_makers[deployment] = sessionmaker(bind=engine)
+            return cls._session_makers[deployment]
+
+    @classmethod
+    def _database_uri(cls, deployment):
+        # Only kept in memory, it includes the database password
+        if deployment not in cls._database_uris:
+            # Config caches secrets per class, not per deployment, so don't let another deployment's be used
+            UploadDbConfig.reset()
+            cls._database_uris[deployment] = UploadDbConfig(deployment=deployment).database_uri
+        return cls._database_uris[deployment]
 
     def session(self):
         return self.session_maker()
@@ -214,17 +275,204 @@ class DbValidationFiles(DbBase):
     validation = relationship("DbValidation", back_populates='validation_files')
 
 
+class UploadAreaReport(EntityBase):
+
+    """
+    The health of an upload area, summarized by the database: GROUP BY queries count the area's files and their
+    checksum, validation and notification records by status, and work out durations, so no more than a few rows
+    per status (and LISTED_ROWS_LIMIT failed or stuck records per kind) ever come back, however big the area is.
+    """
+
+    # Statuses that mean the work is done, anything else that isn't FAILED is still in progress
+    DONE_STATUSES = {
+        'checksum': 'CHECKSUMMED',
+        'validation': 'VALIDATED',
+        'notification': 'DELIVERED'
+    }
+    FAILED_STATUS = 'FAILED'
+    # Work that is in progress but hasn't been updated for this long is reported as stuck
+    STUCK_AFTER = timedelta(hours=1)
+    LISTED_ROWS_LIMIT = 20
+    DURATION_PERCENTILES = (50, 95, 99)
+
+    @classmethod
+    def generate(cls, session, area):
+        """Query the database for the health of an upload area (a DbUploadArea)."""
+        report = cls(area)
+        file_ids = session.query(DbFile.id).filter(DbFile.upload_area_id == area.id)
+        report.file_count, report.total_bytes = session.query(func.count(DbFile.id),
+                                                              func.coalesce(func.sum(DbFile.size), 0)) \
+            .filter(DbFile.upload_area_id == area.id).one()
+        report.files_without_checksums = file_ids \
+            .filter(~session.query(DbChecksum.id).filter(DbChecksum.file_id == DbFile.id).exists()).count()
+
+        # The area's records are picked out with IN (subquery) rather than by joining them to its files, so that a
+        # validation of several files is still only counted once.
+        # Queries, rather than .subquery()s, which IN (...) would have to coerce back into SELECTs
+        area_validation_ids = session.query(DbValidationFiles.validation_id) \
+            .filter(DbValidationFiles.file_id.in_(file_ids))
+        # (kind, model, query of the area's records of that kind, how to join them to their files, start and end
+        # columns)
+        kinds = [
+            ('checksum', DbChecksum, session.query(DbChecksum).filter(DbChecksum.file_id.in_(file_ids)),
+             [DbFile], DbChecksum.checksum_started_at, DbChecksum.checksum_ended_at),
+            ('validation', DbValidation, session.query(DbValidation).filter(DbValidation.id.in_(area_validation_ids)),
+             [DbValidationFiles, DbFile], DbValidation.validation_started_at, DbValidation.validation_ended_at),
+            ('notification', DbNotification,
+             session.query(DbNotification).filter(DbNotification.file_id.in_(file_ids)),
+             [DbFile], None, None)
+        ]
+        stuck_before = datetime.utcnow() - cls.STUCK_AFTER
+        for kind, model, records, file_joins, started_at, ended_at in kinds:
+            stats = {'status_counts': dict(records.with_entities(model.status, func.count(model.id))
+                                           .group_by(model.status).all())}
+            in_progress = records.filter(model.status.notin_([cls.DONE_STATUSES[kind], cls.FAILED_STATUS]))
+            stuck = in_progress.filter(model.updated_at < stuck_before)
+            failed = records.filter(model.status == cls.FAILED_STATUS)
+            stats['stuck_count'] = stuck.count()
+            stats['stuck'] = cls._listed_rows(stuck, model, file_joins)
+            stats['failed'] = cls._listed_rows(failed, model, file_joins)
+            if started_at is not None:
+                finished = records.filter(model.status == cls.DONE_STATUSES[kind])
+                stats['durations'] = cls._duration_percentiles(finished, started_at, ended_at)
+            setattr(report, kind, stats)
+        return report
+
+    @classmethod
+    def _listed_rows(cls, records, model, file_joins):
+        """List the first records, by the name of (one of) their files, one row per record."""
+        for file_join in file_joins:
+            records = records.join(file_join)
+        return records.with_entities(func.min(DbFile.name), model.status, model.updated_at) \
+            .group_by(model.id, model.status, model.updated_at) \
+            .order_by(model.updated_at).limit(cls.LISTED_ROWS_LIMIT).all()
+
+    @classmethod
+    def _duration_percentiles(cls, records, started_at, ended_at):
+        """Return percentiles and maximum of how long records took, in seconds, worked out by (PostgreSQL) itself."""
+        duration = func.extract('epoch', ended_at - started_at)
+        row = records.with_entities(*[func.percentile_cont(percentile / 100).within_group(duration)
+                                      for percentile in cls.DURATION_PERCENTILES],
+                                    func.max(duration)).one()
+        durations = {f"p{percentile}": value for percentile, value in zip(cls.DURATION_PERCENTILES, row)}
+        durations['max'] = row[-1]
+        return durations
+
+    def __init__(self, area):
+        self.area = area
+        self.file_count = 0
+        self.total_bytes = 0
+        self.files_without_checksums = 0
+        self.checksum = {}
+        self.validation = {}
+        self.notification = {}
+
+    def __str__(self, prefix="", verbose=False):
+        output = colored(f"{prefix}Upload Area {self.area.id}: {self.area.uuid} health report\n", 'blue') + \
+            f"{prefix}    Status: {self.area.status}\n" \
+            f"{prefix}    Files: {self.file_count}, {self.total_bytes} bytes\n" \
+            f"{prefix}    Files without checksum records: {self.files_without_checksums}\n"
+        for kind in ('checksum', 'validation', 'notification'):
+            stats = getattr(self, kind)
+            status_counts = ", ".join(f"{status} {count}" for status, count in sorted(stats['status_counts'].items()))
+            output += colored(f"{prefix}    {kind.capitalize()}s: ", 'cyan') + f"{status_counts or 'none'}\n"
+            durations = stats.get('durations')
+            if durations and durations['max'] is not None:
+                output += f"{prefix}        Duration: " + \
+                    ", ".join(f"{name} {seconds:.1f}s" for name, seconds in durations.items()) + "\n"
+            if stats['stuck_count']:
+                output += f"{prefix}        Stuck (no update for {self.STUCK_AFTER}): {stats['stuck_count']}\n"
+                output += self._rows_str(stats['stuck'], stats['stuck_count'], prefix)
+            failed_count = stats['status_counts'].get(self.FAILED_STATUS, 0)
+            if failed_count:
+                output += f"{prefix}        Failed: {failed_count}\n"
+                output += self._rows_str(stats['failed'], failed_count, prefix)
+        return output
+
+    def _rows_str(self, rows, count, prefix):
+        output = "".join(f"{prefix}            {name} ({status} since {updated_at})\n"
+                         for name, status, updated_at in rows)
+        if count > len(rows):
+            output += f"{prefix}            ...and {count - len(rows)} more\n"
+        return output
+
+    def print(self, prefix="", verbose=False, associated_entities_to_show=None):
+        print(self.__str__(prefix=prefix, verbose=verbose))
+
+
+class BatchJobResolver:
+
+    # The most job IDs describe_jobs accepts at once
+    MAX_JOBS_PER_REQUEST = 100
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        """Looks up AWS Batch jobs, many at a time, and remembers them.
+
+        Call prefetch() with the IDs of all the jobs that are about to be needed (e.g. those of every validation
+        in a print tree), then find() hands them out without any more requests.  Jobs Batch has no record of are
+        remembered too, so they aren't asked for again.
+        """
+        self._jobs = {}
+        self._batch = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide resolver."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @property
+    def batch(self):
+        if self._batch is None:
+            self._batch = boto3.client('batch')
+        return self._batch
+
+    def prefetch(self, job_ids):
+        """Look up all of these jobs that haven't been already, MAX_JOBS_PER_REQUEST per request."""
+        with self._lock:
+            unknown_job_ids = list(dict.fromkeys(job_id for job_id in job_ids if job_id not in self._jobs))
+            for start in range(0, len(unknown_job_ids), self.MAX_JOBS_PER_REQUEST):
+                requested_job_ids = unknown_job_ids[start:start + self.MAX_JOBS_PER_REQUEST]
+                response = self.batch.describe_jobs(jobs=requested_job_ids)
+                assert 'jobs' in response
+                for job_id in requested_job_ids:
+                    self._jobs[job_id] = None
+                for aws_job_data in response['jobs']:
+                    self._jobs[aws_job_data['jobId']] = aws_job_data
+
+    def find(self, job_id):
+        """Return the job with this ID as a BatchJob, looking it up if it wasn't prefetched.
+
+        Raises:
+            DcpDiagException: If Batch has no record of the job.
+        """
+        self.prefetch([job_id])
+        with self._lock:
+            aws_job_data = self._jobs[job_id]
+        if aws_job_data is None:
+            raise DcpDiagException(f"AWS does not have a record of batch job \"{job_id}\"")
+        return BatchJob(aws_job_data=aws_job_data)
+
+    def refresh(self, job_id):
+        """Forget what we know about a job, and look it up again (e.g. to see whether it is still running)."""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        return self.find(job_id)
+
+
 class BatchJob(EntityBase):
 
+    FINAL_STATUSES = ('SUCCEEDED', 'FAILED')
+
     @classmethod
     def find_by_id(cls, job_id):
-        batch = boto3.client('batch')
-        response = batch.describe_jobs(jobs=[job_id])
-        assert 'jobs' in response
-        if len(response['jobs']) == 0:
-            raise DcpDiagException(f"AWS does not have a record of batch job \"{job_id}\"")
-        assert len(response['jobs']) == 1
-        return cls(aws_job_data=response['jobs'][0])
+        return BatchJobResolver.shared().find(job_id)
 
     def __init__(self, aws_job_data):
         self.job = aws_job_data
@@ -283,10 +531,16 @@ class BatchJob(EntityBase):
             prefix = f"\t{prefix}"
             if 'logs' in associated_entities_to_show or 'all' in associated_entities_to_show:
                 log_stream_name = self.job['container']['logStreamName']
-                log = CloudWatchLog(log_group_name='/aws/batch/job', log_stream_name=log_stream_name)
+                log = CloudWatchLog(log_group_name='/aws/batch/job', log_stream_name=log_stream_name,
+                                    keep_following=self.is_running)
                 log.print(prefix=prefix, verbose=verbose,
                           associated_entities_to_show=associated_entities_to_show)
 
+    def is_running(self):
+        """Look the job up again, and return whether it has yet to finish."""
+        self.job = BatchJobResolver.shared().refresh(self.id).job
+        return self.job.get('status') not in self.FINAL_STATUSES
+
     @staticmethod
     def _datetime(dictionary, key):
         if key in dictionary and dictionary[key]:
@@ -297,19 +551,62 @@ class BatchJob(EntityBase):
 
 class CloudWatchLog(EntityBase):
 
-    def __init__(self, log_group_name, log_stream_name):
+    # The most events get_log_events returns at once
+    MAX_EVENTS_PER_REQUEST = 10000
+    # Seconds to wait before looking for new events, when following a log
+    FOLLOW_INTERVAL = 5
+
+    _options = {'tail': None, 'start_time': None, 'end_time': None, 'filter_pattern': None, 'follow': False}
+    _logs = None
+    _logs_lock = threading.Lock()
+
+    def __init__(self, log_group_name, log_stream_name, keep_following=None, **options):
+        """A CloudWatch log stream, read a page at a time as it is printed, so a log of any size prints in constant
+        memory.
+
+        Args:
+            keep_following (callable): When following, stop once this returns False (e.g. because the job writing
+                the log has finished).  Without it, follow until interrupted.
+            options: Any of the options of configure(), for this log only.
+        """
         self.log_group_name = log_group_name
         self.log_stream_name = log_stream_name
-        self.logs = boto3.client('logs')
+        self.keep_following = keep_following
+        self.options = dict(self._options, **options)
+
+    @classmethod
+    def configure(cls, tail=None, start_time=None, end_time=None, filter_pattern=None, follow=False):
+        """Set how logs created from now on are read.
+
+        Args:
+            tail (int): Only show the last this many events.
+            start_time (datetime): Only show events from this time on.
+            end_time (datetime): Only show events from before this time.
+            filter_pattern (str): Only show events matching this CloudWatch Logs filter pattern, which CloudWatch
+                applies, so events that don't match are never downloaded.
+            follow (bool): Once at the end of the log, keep waiting for new events and show them as they arrive.
+        """
+        cls._options = {'tail': tail, 'start_time': start_time, 'end_time': end_time,
+                        'filter_pattern': filter_pattern, 'follow': follow}
+
+    @property
+    def logs(self):
+        with self._logs_lock:
+            if CloudWatchLog._logs is None:
+                CloudWatchLog._logs = boto3.client('logs')
+            return CloudWatchLog._logs
+
+    def events(self):
+        """Yield the log's events oldest first, requesting each page only when the previous one has been consumed."""
+        if self.options['filter_pattern']:
+            return self._filtered_events()
+        return self._stream_events()
 
     def __str__(self, prefix="", verbose=False):
         output = colored(f"{prefix}Log:\n", 'red')
         if self.log_stream_name:
             try:
-                response = self.logs.get_log_events(logGroupName=self.log_group_name,
-                                                    logStreamName=self.log_stream_name)
-                assert 'events' in response
-                for event in response['events']:
+                for event in self.events():
                     output += event['message'] + "\n"
             except ClientError:
                 pass
@@ -318,7 +615,111 @@ class CloudWatchLog(EntityBase):
         return output
 
     def print(self, prefix="", verbose=False, associated_entities_to_show=None):
-        print(self.__str__(prefix=prefix, verbose=verbose))
+        print(colored(f"{prefix}Log:", 'red'))
+        if self.log_stream_name:
+            try:
+                for event in self.events():
+                    print(event['message'], flush=self.options['follow'])
+            except ClientError:
+                pass
+        else:
+            print("No log yet.")
+        print()
+
+    def _stream_events(self):
+        request = dict(logGroupName=self.log_group_name, logStreamName=self.log_stream_name, startFromHead=True,
+                       **self._time_window())
+        if self.options['tail']:
+            events, request['nextToken'] = self._last_stream_events(request)
+            yield from events
+            if not self.options['follow']:
+                return
+        stopped = False
+        while True:
+            response = self.logs.get_log_events(**request)
+            yield from response['events']
+            if response['nextForwardToken'] != request.get('nextToken'):
+                request['nextToken'] = response['nextForwardToken']
+                continue
+            # Being handed back the token we sent means we are at the end of the stream
+            if stopped or not self.options['follow']:
+                return
+            stopped = not self._wait_for_more()
+
+    def _last_stream_events(self, request):
+        """Return the last "tail" events of the stream, and the token to read on from after them."""
+        tail = self.options['tail']
+        request = dict(request, startFromHead=False)
+        pages = deque()
+        event_count = 0
+        forward_token = None
+        while event_count < tail:
+            request['limit'] = min(tail - event_count, self.MAX_EVENTS_PER_REQUEST)
+            response = self.logs.get_log_events(**request)
+            if forward_token is None:
+                forward_token = response['nextForwardToken']
+            pages.appendleft(response['events'])
+            event_count += len(response['events'])
+            if response['nextBackwardToken'] == request.get('nextToken'):
+                break
+            request['nextToken'] = response['nextBackwardToken']
+        events = [event for page in pages for event in page]
+        return events[max(0, len(events) - tail):], forward_token
+
+    def _filtered_events(self):
+        request = dict(logGroupName=self.log_group_name, logStreamNames=[self.log_stream_name],
+                       filterPattern=self.options['filter_pattern'], **self._time_window())
+        tail = deque(maxlen=self.options['tail']) if self.options['tail'] else None
+        latest_timestamp = None
+        latest_event_ids = set()
+        stopped = False
+        while True:
+            response = self.logs.filter_log_events(**request)
+            for event in response['events']:
+                if event['eventId'] in latest_event_ids:
+                    continue
+                if event['timestamp'] != latest_timestamp:
+                    latest_timestamp = event['timestamp']
+                    latest_event_ids = set()
+                latest_event_ids.add(event['eventId'])
+                if tail is not None:
+                    tail.append(event)
+                else:
+                    yield event
+            if 'nextToken' in response:
+                request['nextToken'] = response['nextToken']
+                continue
+            if tail is not None:
+                yield from tail
+                tail = None
+            if stopped or not self.options['follow']:
+                return
+            stopped = not self._wait_for_more()
+            # There is no token to carry on from at the end, so search again from the newest event seen, skipping
+            # the events at that time that we already have.
+            request.pop('nextToken', None)
+            if latest_timestamp is not None:
+                request['startTime'] = latest_timestamp
+
+    def _wait_for_more(self):
+        """At the end of a log that is being followed, wait for more events to be written.
+
+        Returns:
+            bool: False if keep_following says to stop.  One last look for events written before the writer
+                stopped is still worth making.
+        """
+        if self.keep_following is not None and not self.keep_following():
+            return False
+        time.sleep(self.FOLLOW_INTERVAL)
+        return True
+
+    def _time_window(self):
+        window = {}
+        if self.options['start_time']:
+            window['startTime'] = int(self.options['start_time'].timestamp() * 1000)
+        if self.options['end_time']:
+            window['endTime'] = int(self.options['end_time'].timestamp() * 1000)
+        return window
 
 
 DbUploadArea.files = relationship('DbFile', order_by=DbFile.id, back_populates='upload_area')
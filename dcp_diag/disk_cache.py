@@ -0,0 +1,49 @@
+import json
+import os
+import re
+import time
+
+
+class DiskCache:
+
+    DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'dcp-diag')
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, ttl=None):
+        """A directory of JSON files, for keeping API responses between runs.
+
+        Args:
+            directory (str): Where to keep the cache files.
+            ttl (int): Entries older than this many seconds are treated as missing.  None means they never expire.
+        """
+        self.directory = directory
+        self.ttl = ttl
+
+    def get(self, key):
+        """Return the value cached under key, or None if there isn't one or it has expired."""
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump(value, fp)
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key):
+        # keys look like "azul/prod/<uuid>", keep each part filesystem safe
+        parts = [re.sub(r'[^\w.-]', '_', part) for part in key.split('/')]
+        return os.path.join(self.directory, *parts) + '.json'
@@ -1,18 +1,32 @@
+import collections
 import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from dcplib.component_agents import IngestApiAgent
 from dcplib.component_entities.ingest_entities import SubmissionEnvelope, Project
 
 from .finder import Finder
+from .ingest_index import IngestIndex
 
 
 class IngestFinder:
 
     name = "ingest"
 
-    def __init__(self, deployment, **args):
+    DEFAULT_JOBS = 8
+    SCAN_PAGE_SIZE = 500
+
+    def __init__(self, deployment, jobs=DEFAULT_JOBS, **args):
+        """
+        Args:
+            deployment (str): The deployment to search.
+            jobs (int): Number of concurrent requests to make when searching through submissions.
+        """
         self.ingest = IngestApiAgent(deployment=deployment)
+        self.index = IngestIndex(deployment=deployment)
+        self.jobs = max(jobs or self.DEFAULT_JOBS, 1)
 
     def find(self, expression):
 
@@ -37,29 +51,129 @@ class IngestFinder:
             exit(1)
 
     def find_submission_by_uuid(self, subm_uuid):
-        print(f"Searching for submission with UUID {subm_uuid}...")
-        count = 0
-        for subm in SubmissionEnvelope.iter_submissions():
-            count += 1
-            sys.stdout.write(f"\rSearched {count} submissions...")
-            sys.stdout.flush()
+        envelope_id = self._look_up(lambda: self.index.submission_id_for_uuid(subm_uuid))
+        if envelope_id:
+            print(f"Submission {envelope_id} has UUID {subm_uuid}")
+            return SubmissionEnvelope.load_by_id(submission_id=envelope_id, ingest_api_agent=self.ingest)
 
-            if subm.uuid == subm_uuid:
-                print(f"\nSubmission {subm.envelope_id} has UUID {subm_uuid}")
-                return subm
+        print(f"Searching for submission with UUID {subm_uuid}...")
+        subm = self._scan(lambda submission, bundle_uuids: submission.uuid == subm_uuid)
+        if subm:
+            print(f"\nSubmission {subm.envelope_id} has UUID {subm_uuid}")
+            return subm
 
     def find_submission_with_bundle_uuid(self, bundle_uuid):
+        envelope_ids = self._look_up(lambda: self.index.submission_ids_for_bundle(bundle_uuid))
+        if envelope_ids:
+            print(f"Bundle {bundle_uuid} is in the manifest for submission {envelope_ids[0]}")
+            return SubmissionEnvelope.load_by_id(submission_id=envelope_ids[0], ingest_api_agent=self.ingest)
+
         print(f"Searching for submission with Bundle {bundle_uuid}...")
-        count = 0
-        for subm in SubmissionEnvelope.iter_submissions():
-            count += 1
-            sys.stdout.write(f"\rSearched {count} submissions...")
-            sys.stdout.flush()
-
-            for subm_bundle_uuid in subm.bundles():
-                if subm_bundle_uuid == bundle_uuid:
-                    print(f"\nBundle {bundle_uuid} is in the manifest for submission {subm.envelope_id}")
-                    return subm
+        subm = self._scan(lambda submission, bundle_uuids: bundle_uuid in bundle_uuids, with_bundles=True)
+        if subm:
+            print(f"\nBundle {bundle_uuid} is in the manifest for submission {subm.envelope_id}")
+            return subm
+
+    def _look_up(self, lookup):
+        """Look something up in the local index, bringing the index up to date and trying again if it isn't there.
+
+        Returns None if it isn't there either, so the caller can fall back to scanning through Ingest itself
+        (the index doesn't have the bundles of submissions that are still being processed).
+        """
+        result = lookup()
+        if result:
+            return result
+        print("Updating the local index of submissions...")
+        self.index.update(self.ingest, progress_callback=self._print_index_progress, jobs=self.jobs)
+        print()
+        return lookup()
+
+    @staticmethod
+    def _print_index_progress(submissions_checked):
+        sys.stdout.write(f"\rChecked {submissions_checked} new or updated submissions...")
+        sys.stdout.flush()
+
+    def _scan(self, matches, with_bundles=False):
+        """Search through every submission, newest first, for one that matches.
+
+        Pages of submissions are fetched several at a time, and, if with_bundles, each submission's bundle list is
+        looked up in a pool of self.jobs workers.  Pages have workers of their own, so the next pages are fetched
+        while bundle lists are being looked up rather than queueing behind them, and only a few lookups per worker
+        are queued at a time.  Every worker stops as soon as a match has been found, so if several submissions match,
+        this may not return the newest one.
+
+        Args:
+            matches (callable): Called as matches(submission, bundle_uuids), where bundle_uuids is the submission's
+                bundle list if with_bundles, or None.  Returns True if this is the submission we are looking for.
+            with_bundles (bool): Look up the bundle list of every submission.
+
+        Returns:
+            SubmissionEnvelope: A matching submission, or None if there isn't one.
+        """
+        stop = threading.Event()
+        found_submissions = []
+        searched_count = [0]
+        lock = threading.Lock()
+
+        def check(submission):
+            if stop.is_set():
+                return
+            bundle_uuids = submission.bundles() if with_bundles else None
+            with lock:
+                searched_count[0] += 1
+                sys.stdout.write(f"\rSearched {searched_count[0]} submissions...")
+                sys.stdout.flush()
+                if not stop.is_set() and matches(submission, bundle_uuids):
+                    found_submissions.append(submission)
+                    stop.set()
+
+        def fetch_page(page_number):
+            return [] if stop.is_set() else self._submissions_page(page_number)[0]
+
+        def iter_pages(page_executor):
+            first_page, total_pages = self._submissions_page(0)
+            yield first_page
+            # the page numbers are known from the first page, so fetch up to self.jobs pages ahead of need,
+            # rather than one at a time following "next" links
+            page_futures = collections.deque()
+            next_page_number = 1
+            while next_page_number < total_pages or page_futures:
+                while next_page_number < total_pages and len(page_futures) < self.jobs:
+                    page_futures.append(page_executor.submit(fetch_page, next_page_number))
+                    next_page_number += 1
+                yield page_futures.popleft().result()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as page_executor, \
+                ThreadPoolExecutor(max_workers=self.jobs) as check_executor:
+            try:
+                check_futures = collections.deque()
+                for submissions in iter_pages(page_executor):
+                    for submission in submissions:
+                        if stop.is_set():
+                            break
+                        if with_bundles:
+                            # wait for the oldest lookup before queueing more, so they don't pile up in memory
+                            while len(check_futures) >= self.jobs * 2:
+                                check_futures.popleft().result()
+                            check_futures.append(check_executor.submit(check, submission))
+                        else:
+                            check(submission)
+                    if stop.is_set():
+                        break
+                for check_future in check_futures:
+                    check_future.result()
+            finally:
+                # found it, failed or were interrupted, either way the remaining work isn't needed
+                stop.set()
+        return found_submissions[0] if found_submissions else None
+
+    def _submissions_page(self, page_number):
+        """Return the submissions on one page of all submissions, newest first, and how many pages there are."""
+        data = self.ingest.get(f"/submissionEnvelopes?page={page_number}&size={self.SCAN_PAGE_SIZE}"
+                               f"&sort=submissionDate,desc")
+        submissions = [SubmissionEnvelope(submission_data=submission_data, ingest_api_agent=self.ingest)
+                       for submission_data in data.get('_embedded', {}).get('submissionEnvelopes', [])]
+        return submissions, data.get('page', {}).get('totalPages', 1)
 
 
 Finder.register(IngestFinder)
@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dcplib.component_entities.ingest_entities import SubmissionEnvelope
+
+from dcp_diag.disk_cache import DiskCache
+
+
+class IngestIndex:
+
+    """
+    A local index of Ingest submissions, for finding a submission by its UUID, or by one of its bundles, without
+    scanning every submission.
+
+    The index records each submission's UUID, envelope ID, dates and status, and the bundles of those that are
+    Complete (bundles are only all there once a submission is complete).  update() brings it up to date by paging
+    through submissions most recently updated first, stopping at those that hadn't changed since the last update.
+    That picks up new submissions, and ones that have completed since.
+
+    The first update() pages through every submission, and looks up the bundles of every complete one, so it is
+    slow.  It can be interrupted: submissions that are already indexed as complete are skipped next time.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS submissions (
+            uuid TEXT PRIMARY KEY,
+            envelope_id TEXT NOT NULL,
+            submission_date TEXT,
+            update_date TEXT,
+            status TEXT
+        );
+        CREATE TABLE IF NOT EXISTS bundles (
+            bundle_uuid TEXT NOT NULL,
+            submission_uuid TEXT NOT NULL,
+            PRIMARY KEY (bundle_uuid, submission_uuid)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    FINAL_STATUS = 'Complete'
+    # Commit after indexing this many submissions, so an interrupted update loses little work
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, deployment, path=None):
+        """
+        Args:
+            deployment (str): The deployment whose submissions are indexed, each deployment has its own index.
+            path (str): Where to keep the index, by default a file in the dcp-diag cache directory.
+        """
+        self.deployment = deployment
+        self.path = path or os.path.join(DiskCache.DEFAULT_DIRECTORY, f"ingest-index-{deployment}.sqlite")
+        self._db = None
+        self._lock = threading.Lock()
+        self._uncommitted_count = 0
+
+    @property
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(self.SCHEMA)
+        return self._db
+
+    def submission_id_for_uuid(self, submission_uuid):
+        """Return the envelope ID of the submission with this UUID, or None if it isn't in the index."""
+        with self._lock:
+            row = self.db.execute("SELECT envelope_id FROM submissions WHERE uuid = ?", (submission_uuid,)).fetchone()
+        return row[0] if row else None
+
+    def submission_ids_for_bundle(self, bundle_uuid):
+        """Return the envelope IDs of the submissions with this bundle in their manifest, newest first."""
+        with self._lock:
+            rows = self.db.execute("SELECT s.envelope_id FROM bundles b "
+                                   "JOIN submissions s ON s.uuid = b.submission_uuid "
+                                   "WHERE b.bundle_uuid = ? ORDER BY s.submission_date DESC",
+                                   (bundle_uuid,)).fetchall()
+        return [row[0] for row in rows]
+
+    def update(self, ingest_api_agent, progress_callback=None, jobs=1):
+        """Bring the index up to date with Ingest.
+
+        Args:
+            ingest_api_agent (IngestApiAgent): Agent to query Ingest with.
+            progress_callback (callable): Called as progress_callback(submissions_checked) after each submission.
+            jobs (int): Number of submissions' bundle lists to look up at the same time.
+        """
+        up_to_date_until = self._meta('up_to_date_until')
+        newest_update_date = up_to_date_until
+        checked_count = [0]
+        progress_lock = threading.Lock()
+
+        def add(submission):
+            self.add(submission)
+            with progress_lock:
+                checked_count[0] += 1
+                if progress_callback:
+                    progress_callback(checked_count[0])
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            add_futures = []
+            for submission in SubmissionEnvelope.iter_submissions(ingest_api_agent=ingest_api_agent,
+                                                                  sort_by='updateDate,desc'):
+                if up_to_date_until and submission.update_date < up_to_date_until:
+                    # nothing from here on has changed since the last update
+                    break
+                add_futures.append(executor.submit(add, submission))
+                if newest_update_date is None or submission.update_date > newest_update_date:
+                    newest_update_date = submission.update_date
+            for add_future in add_futures:
+                add_future.result()
+
+        with self._lock:
+            # only now, so that an interrupted update starts from the top again next time
+            if newest_update_date:
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('up_to_date_until', ?)",
+                                (newest_update_date,))
+            self.db.commit()
+            self._uncommitted_count = 0
+
+    def add(self, submission):
+        """Index a submission, and its bundles if it is complete.  Does nothing if it is already indexed as complete.
+
+        Returns:
+            bool: True if the submission's bundles were looked up.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT status FROM submissions WHERE uuid = ?", (submission.uuid,)).fetchone()
+        if row and row[0] == self.FINAL_STATUS:
+            return False
+        complete = submission.status == self.FINAL_STATUS
+        bundle_uuids = submission.bundles() if complete else []
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO submissions "
+                            "(uuid, envelope_id, submission_date, update_date, status) VALUES (?, ?, ?, ?, ?)",
+                            (submission.uuid, submission.envelope_id, submission.submission_date,
+                             submission.update_date, submission.status))
+            self.db.executemany("INSERT OR IGNORE INTO bundles (bundle_uuid, submission_uuid) VALUES (?, ?)",
+                                [(bundle_uuid, submission.uuid) for bundle_uuid in bundle_uuids])
+            self._uncommitted_count += 1
+            if self._uncommitted_count >= self.COMMIT_INTERVAL:
+                self.db.commit()
+                self._uncommitted_count = 0
+        return complete
+
+    def _meta(self, key):
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
@@ -1,30 +1,56 @@
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm.exc import NoResultFound
 
 from .. import DcpDiagException
 from .finder import Finder
 
-from dcp_diag.component_entities.upload_entities import DbUploadArea, DbFile, DbValidation, BatchJob, DBSessionMaker
+from dcp_diag.component_entities.upload_entities import DbUploadArea, DbFile, DbValidation, DbValidationFiles, \
+    BatchJob, BatchJobResolver, CloudWatchLog, DBSessionMaker, UploadAreaReport
 
 
 class UploadFinder:
 
     """
     dcpdig @upload area=<uuid>
+    dcpdig @upload area=<uuid> --report
     dcpdig @upload file_id=<upload-area>/<filename>
+    dcpdig @upload batch_job=<job-id> --show logs --follow
     """
 
     name = 'upload'
 
-    def __init__(self, deployment, **args):
+    def __init__(self, deployment, entities_to_show=None, report=False,
+                 tail=None, since=None, until=None, filter_pattern=None, follow=False, **args):
+        """
+        Args:
+            deployment (str): The deployment to search.
+            entities_to_show (list): Entities that will be printed, so they can be loaded up front.
+            report (bool): Find upload areas as an UploadAreaReport rather than everything in them.
+            tail, since, until, filter_pattern, follow: How to read batch job logs, see CloudWatchLog.configure().
+        """
         self.deployment = deployment
+        self.entities_to_show = set(entities_to_show or [])
+        self.report = report
+        CloudWatchLog.configure(tail=tail, start_time=since, end_time=until, filter_pattern=filter_pattern,
+                                follow=follow)
+        self._db = None
+
+    @property
+    def db(self):
+        """A session kept for all of this finder's lookups (entities found use it to load related rows)."""
+        if self._db is None:
+            self._db = DBSessionMaker(self.deployment).session()
+        return self._db
 
     def find(self, expression):
         field_name, field_value = expression.split('=')
-        db = DBSessionMaker(self.deployment).session()
+        db = self.db
 
         if field_name == 'file':
             try:
-                file = db.query(DbFile).filter(DbFile.s3_key == field_value).one()
+                file = db.query(DbFile).options(*self._file_loader_options()) \
+                    .filter(DbFile.s3_key == field_value).one()
+                self._prefetch_batch_jobs([file])
                 return file
             except NoResultFound:
                 raise DcpDiagException(f"No record of File \"{field_value}\""
@@ -32,7 +58,12 @@ class UploadFinder:
 
         elif field_name == 'area_id' or field_name == 'area':
             try:
-                area = db.query(DbUploadArea).filter(DbUploadArea.uuid == field_value).one()
+                if self.report:
+                    area = db.query(DbUploadArea).filter(DbUploadArea.uuid == field_value).one()
+                    return UploadAreaReport.generate(db, area)
+                area = db.query(DbUploadArea).options(*self._area_loader_options()) \
+                    .filter(DbUploadArea.uuid == field_value).one()
+                self._prefetch_batch_jobs(area.files if self._shows('files') else [])
                 return area
             except NoResultFound:
                 raise DcpDiagException(f"No record of Upload Area \"{field_value}\""
@@ -52,5 +83,47 @@ class UploadFinder:
         else:
             raise DcpDiagException(f"Sorry I don't know how to find an {field_name}")
 
+    def _shows(self, entity):
+        return entity in self.entities_to_show or 'all' in self.entities_to_show
+
+    def _prefetch_batch_jobs(self, files):
+        """Look up the batch jobs of all the validations printing these files will show, in as few requests as
+        possible, rather than one at a time as each validation is printed.
+        """
+        if not (self._shows('validations') and self._shows('batch_jobs')):
+            return
+        BatchJobResolver.shared().prefetch(join_table_row.validation.job_id
+                                           for file in files for join_table_row in file.validation_files)
+
+    def _area_loader_options(self):
+        """Load everything printing an upload area will show up front, rather than a few rows at a time as it's printed.
+
+        Each relationship is loaded with one more query (SELECT ... WHERE ... IN (...)) for all the rows at once, so
+        an area and its files, checksums, validations and notifications take a handful of queries however many
+        files it has, rather than several for every file.
+        """
+        if not self._shows('files'):
+            return []
+        files = selectinload(DbUploadArea.files)
+        return [files] + self._file_loader_options(files)
+
+    def _file_loader_options(self, files=None):
+        """Load the relationships of files that printing them will show.
+
+        Args:
+            files: The loader option the files are loaded by, when they aren't what is being queried for.
+        """
+        def load(relationship):
+            return files.selectinload(relationship) if files is not None else selectinload(relationship)
+
+        options = []
+        if self._shows('checksums'):
+            options.append(load(DbFile.checksum_records))
+        if self._shows('validations'):
+            options.append(load(DbFile.validation_files).joinedload(DbValidationFiles.validation))
+        if self._shows('notifications'):
+            options.append(load(DbFile.notifications))
+        return options
+
 
 Finder.register(UploadFinder)
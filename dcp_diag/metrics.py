@@ -0,0 +1,110 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Replace the IDs in request paths, so requests for different bundles, workflows etc. count as the same endpoint
+_PATH_ID_PATTERNS = [
+    (re.compile(r'[0-9a-f]{8}-([0-9a-f]{4}-){3}[0-9a-f]{12}(\.[0-9TZ.]+)?', re.IGNORECASE), '{uuid}'),
+    (re.compile(r'(?<=/)[0-9a-f]{16,}(?=/|$)', re.IGNORECASE), '{id}'),
+]
+
+
+class Metrics:
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        """Timings and request statistics for a run, for working out which phase or service is eating the time.
+
+        The HTTP layers of the component agents (HTTPSessionPool, RetryPolicy and AsyncDataStoreAgent) report every
+        request attempt here, and scripts time their phases with phase().
+        """
+        self.started_at = time.time()
+        self._phases = {}
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide metrics."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @contextmanager
+    def phase(self, name):
+        """Record the wall clock and CPU time spent in the body of the with statement.
+
+        CPU time is that of the whole process, so it includes any other phases running at the same time.
+        """
+        wall_started_at = time.perf_counter()
+        cpu_started_at = time.process_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                phase = self._phases.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                phase['wall_seconds'] += time.perf_counter() - wall_started_at
+                phase['cpu_seconds'] += time.process_time() - cpu_started_at
+
+    def record_request(self, method, url, status=None, latency=0.0, bytes_received=0, retried=False, error=False):
+        """Record one attempt at an HTTP request.
+
+        Args:
+            status (int): HTTP status of the response, or None if there wasn't one (e.g. the connection failed).
+            latency (float): Seconds until the response headers arrived.
+            retried (bool): This attempt failed and is going to be retried.
+            error (bool): This attempt failed and isn't going to be retried.
+        """
+        host, endpoint = self._endpoint(method, url)
+        with self._lock:
+            stats = self._endpoints.setdefault(host, {}).setdefault(endpoint, {
+                'requests': 0, 'retries': 0, 'errors': 0, 'bytes_received': 0, 'statuses': {}, 'latencies': []
+            })
+            stats['requests'] += 1
+            stats['retries'] += int(retried)
+            stats['errors'] += int(error)
+            stats['bytes_received'] += bytes_received
+            status_key = str(status) if status else 'no response'
+            stats['statuses'][status_key] = stats['statuses'].get(status_key, 0) + 1
+            stats['latencies'].append(latency)
+
+    def report(self):
+        """Return everything recorded so far, as a JSON-serializable dict."""
+        with self._lock:
+            requests = {
+                host: {endpoint: self._summarize(stats) for endpoint, stats in sorted(endpoints.items())}
+                for host, endpoints in sorted(self._endpoints.items())
+            }
+            return {
+                'wall_seconds': time.time() - self.started_at,
+                'phases': {name: dict(phase) for name, phase in self._phases.items()},
+                'requests': requests
+            }
+
+    def write(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.report(), fp, indent=2)
+
+    @staticmethod
+    def _summarize(stats):
+        summary = {k: v for k, v in stats.items() if k != 'latencies'}
+        latencies = sorted(stats['latencies'])
+        summary['latency_seconds'] = {
+            f"p{percentile}": latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+            for percentile in (50, 95, 99)
+        } if latencies else {}
+        return summary
+
+    @staticmethod
+    def _endpoint(method, url):
+        parsed = urlparse(url)
+        path = parsed.path
+        for pattern, replacement in _PATH_ID_PATTERNS:
+            path = pattern.sub(replacement, path)
+        return parsed.netloc, f"{method.upper()} {path}"
@@ -0,0 +1,163 @@
+import threading
+import types
+import unittest
+from unittest import mock
+
+import requests
+
+from dcp_diag.component_agents.http_session_pool import HTTPSessionPool
+from dcp_diag.component_agents.retry import AdaptiveConcurrencyLimiter, RetryPolicy
+from dcp_diag.metrics import Metrics
+
+URL = 'https://dss.example.org/v1/bundles/x'
+
+
+class StubSession:
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+
+    def request(self, method, url, **kwargs):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response._content = b'{}'
+        response.request = requests.Request(method, url).prepare()
+        return response
+
+
+class TestHTTPSessionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.pool = HTTPSessionPool(pool_size=4, retry_policy=RetryPolicy(max_attempts=3, base_delay=0),
+                                    metrics=self.metrics)
+        self.limiter = self.pool.limiter('dss.example.org')
+
+    def use_session(self, *outcomes):
+        # the same session for every thread, so requests made in other threads use it too
+        self.pool._local = types.SimpleNamespace(session=StubSession(*outcomes))
+
+    def get(self):
+        """Make a request in another thread, failing rather than hanging if it can't get a slot."""
+        outcome = {}
+
+        def get():
+            try:
+                outcome['response'] = self.pool.get(URL)
+            except BaseException as e:
+                outcome['exception'] = e
+
+        thread = threading.Thread(target=get, daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "request blocked waiting for a slot")
+        if 'exception' in outcome:
+            raise outcome['exception']
+        return outcome['response']
+
+    def test_releases_slot_after_unexpected_exception(self):
+        for error in (requests.exceptions.ChunkedEncodingError(), requests.exceptions.TooManyRedirects(),
+                      KeyboardInterrupt()):
+            self.use_session(error)
+            with self.assertRaises(type(error)):
+                self.get()
+            self.assertEqual(0, self.limiter._in_flight)
+
+    def test_unexpected_exception_is_recorded_as_an_error(self):
+        self.use_session(requests.exceptions.ChunkedEncodingError())
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            self.get()
+        stats = self.metrics.report()['requests']['dss.example.org']['GET /v1/bundles/x']
+        self.assertEqual((1, 1, 0), (stats['requests'], stats['errors'], stats['retries']))
+
+    def test_unexpected_exception_counts_as_overloaded(self):
+        limit = self.limiter.limit
+        self.use_session(requests.exceptions.ContentDecodingError())
+        with self.assertRaises(requests.exceptions.ContentDecodingError):
+            self.get()
+        self.assertEqual(max(1, limit // 2), self.limiter.limit)
+
+    def test_requests_still_flow_after_many_failures(self):
+        for _ in range(10):
+            self.use_session(requests.exceptions.ChunkedEncodingError())
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                self.get()
+        self.use_session(200)
+        self.assertEqual(200, self.get().status_code)
+
+    def test_retries_then_releases_slots(self):
+        self.use_session(requests.exceptions.ConnectionError(), 503, 200)
+        with mock.patch('time.sleep'):
+            response = self.get()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, self.limiter._in_flight)
+
+    def test_gives_up_after_max_attempts(self):
+        self.use_session(503, 503, 503)
+        with mock.patch('time.sleep'):
+            response = self.get()
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(0, self.limiter._in_flight)
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+
+    def test_increases_by_one_over_each_limits_worth_of_successes(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=10)
+        for expected_limit in (2, 2, 3):  # 2 + 1/2 + 1/2.5
+            limiter.acquire()
+            limiter.release(latency=0.1)
+            self.assertEqual(expected_limit, limiter.limit)
+
+    def test_never_exceeds_max_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=3)
+        for _ in range(50):
+            limiter.acquire()
+            limiter.release(latency=0.1)
+        self.assertEqual(3, limiter.limit)
+
+    def test_holds_limit_while_latency_is_high(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=10)
+        limiter.acquire()
+        limiter.release(latency=0.1)
+        before = limiter._limit
+        limiter.acquire()
+        limiter.release(latency=10)
+        self.assertEqual(before, limiter._limit)
+
+    def test_halves_when_overloaded(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=10)
+        limiter.acquire()
+        limiter.release(latency=0.1, overloaded=True)
+        self.assertEqual(4, limiter.limit)
+
+    def test_halves_at_most_once_per_interval(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=10)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(latency=0.1, overloaded=True)
+        self.assertEqual(4, limiter.limit)
+
+    def test_never_below_min_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=10)
+        with mock.patch('time.time', side_effect=[1000, 2000, 3000]):
+            for _ in range(3):
+                limiter.acquire()
+                limiter.release(latency=0.1, overloaded=True)
+        self.assertEqual(1, limiter.limit)
+
+    def test_acquire_blocks_at_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=1)
+        limiter.acquire()
+        acquired = threading.Event()
+        threading.Thread(target=lambda: (limiter.acquire(), acquired.set()), daemon=True).start()
+        self.assertFalse(acquired.wait(0.2))
+        limiter.release(latency=0.1)
+        self.assertTrue(acquired.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()